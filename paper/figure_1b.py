@@ -4,6 +4,7 @@
 import os
 import sys
 
+import joblib
 import numpy as np
 import pandas as pd
 
@@ -14,6 +15,49 @@ import enrichment
 import utils
 
 
+def compute_cell(codes, code, m, n_perm, rng):
+    """Computes the observed AUC and its permutation statistics for one amino
+    acid at one position.
+
+    Args:
+        codes (np.array): amino acid codes at current position.
+        code (int): code of the amino acid of interest.
+        m (int): number of occurrences of the amino acid of interest.
+        n_perm (int): number of permutations.
+        rng (np.random.Generator): random number generator of the
+            permutations.
+
+    Returns:
+        float: observed AUC.
+        np.array: null distribution of AUCs.
+        float: two-sided p-value.
+        float: z-score.
+    """
+
+    # Compute the AUC (observed and null). Same analysis can be done
+    # using standard enrichment scores, by changing to the following
+    # snippet of code:
+    # curve_ = enrichment.enrichment_curves(codes=codes, code=code, m=m)
+    # score_obs = enrichment.enrichment_score(curve_)
+    # score_null = enrichment.enrichment_scores_null(
+    #     codes=codes, code=code, m=m, n_perm=n_perm, mode='max', rng=rng
+    # )
+    auc_obs = enrichment.enrichment_auc_fast(codes == code)
+    auc_null = enrichment.enrichment_scores_null(
+        codes=codes, code=code, m=m, n_perm=n_perm, mode='auc', rng=rng
+    )
+
+    # compute the p-values.
+    auc_pvalue = enrichment.twosided_pvalue(auc_obs, auc_null)
+
+    # compute the z-score.
+    auc_zscore = enrichment.zscore(
+        auc_obs, np.mean(auc_null), np.std(auc_null)
+    )
+
+    return auc_obs, auc_null, auc_pvalue, auc_zscore
+
+
 def main():
 
     # input/output paths, input filename.
@@ -26,6 +70,11 @@ def main():
     # ten permutations, but multiple hours for 1'000.
     n_perm = 10
 
+    # seed of the permutations, and number of parallel jobs (-1 uses all
+    # cores). The results do not depend on the number of jobs.
+    seed = 0
+    n_jobs = -1
+
     # whether or not enrichment curves should be stored. This creates a very
     # large file and is only recommended if needed.
     store_enrichment_curves = False
@@ -36,8 +85,8 @@ def main():
 
     # get positions of stop-codons ('*').
     sc_index_raw, sc_pos_raw = np.where(data_df.isin(["*"]).values == 1)
-    sc_index = [x + 1 for x in sc_index_raw]
-    sc_pos = [x + 1 for x in sc_pos_raw]
+    sc_index = sc_index_raw + 1
+    sc_pos = sc_pos_raw + 1
 
     # arrays for AUC scores.
     metrics = ['auc', 'zscore', 'pval_raw', 'counts']
@@ -45,60 +94,61 @@ def main():
     perm_aucs = []
     enrichment_curves = []
 
-    for a_idx, aa in enumerate(acids):
-        for p_idx, pos in enumerate(positions):
-            print(f'at AA={aa}, pos={pos}\r', end='')
-
-            # remove non-relevant peptides from data, i.e. those that
-            # previously had stop-codon.
-            df = enrichment.remove_peptides_with_stopcodon(
-                data_df, pos, sc_index, sc_pos,
-            )
-
-            # check how often an AA occurs at current position in the data set.
-            # If zero, nothing has to be done and we continue with next
-            # position.
-            n_occurrences = df[df == aa].shape[0]
-            out_dict['counts'][p_idx, a_idx] = n_occurrences
-            if n_occurrences == 0:
-                continue
-
-            # compute the enrichment curves.
-            curve_ = enrichment.enrichment_curves(df=df, acid=aa)
-
-            # store enrichment curves.
-            enrichment_curves.append([aa, pos] + list(curve_))
+    # encode all positions once. Non-relevant peptides are removed from data,
+    # i.e. those that previously had stop-codon.
+    columns = []
+    counts = []
+    for p_idx, pos in enumerate(positions):
+        df = enrichment.remove_peptides_with_stopcodon(
+            data_df, pos, sc_index, sc_pos,
+        )
+        codes_, counts_ = enrichment.precompute_column(df, acids)
+        columns.append(codes_)
+        counts.append(counts_)
+
+        # check how often an AA occurs at current position in the data set.
+        out_dict['counts'][p_idx] = counts_
+
+    # every (position, amino acid) combination is independent and gets its
+    # own random number generator, spawned from the seed. If an AA does not
+    # occur at a position, nothing has to be done.
+    jobs = [
+        (p_idx, a_idx)
+        for a_idx in range(len(acids))
+        for p_idx in range(len(positions))
+        if counts[p_idx][a_idx] > 0
+    ]
+    rngs = [
+        np.random.default_rng(x)
+        for x in np.random.SeedSequence(seed).spawn(len(jobs))
+    ]
+
+    results = joblib.Parallel(n_jobs=n_jobs, backend='loky', verbose=5)(
+        joblib.delayed(compute_cell)(
+            columns[p_idx], a_idx, counts[p_idx][a_idx], n_perm, rng,
+        )
+        for (p_idx, a_idx), rng in zip(jobs, rngs)
+    )
 
-            # Compute the AUC (observed and null). Same analysis can be done
-            # using standard enrichment scores, by changing to the following
-            # snippet of code:
-            # score_obs = enrichment.enrichment_score(curve_)
-            # score_null = enrichment.enrichment_scores_null(
-            #     df=df, acid=aa, n_perm=n_perm, mode='max'
-            # )
-            auc_obs = enrichment.enrichment_auc(curve_)
-            auc_null = enrichment.enrichment_scores_null(
-                df=df, acid=aa, n_perm=n_perm, mode='auc'
-            )
+    for (p_idx, a_idx), result in zip(jobs, results):
+        aa, pos = acids[a_idx], positions[p_idx]
+        auc_obs, auc_null, auc_pvalue, auc_zscore = result
 
-            # store the permutations.
-            permutations = [aa, pos, auc_obs] + auc_null
-            perm_aucs.append(permutations)
+        # store the permutations.
+        permutations = [aa, pos, auc_obs] + list(auc_null)
+        perm_aucs.append(permutations)
 
-            # compute the p-values.
-            auc_pvalue = enrichment.twosided_pvalue(auc_obs, auc_null)
+        # store values in array.
+        out_dict['auc'][p_idx, a_idx] = auc_obs
+        out_dict['zscore'][p_idx, a_idx] = auc_zscore
+        out_dict['pval_raw'][p_idx, a_idx] = auc_pvalue
 
-            # compute the z-score.
-            auc_zscore = enrichment.zscore(
-                auc_obs, np.mean(auc_null), np.std(auc_null)
+        # store enrichment curves.
+        if store_enrichment_curves:
+            curve_ = enrichment.enrichment_curves(
+                codes=columns[p_idx], code=a_idx, m=counts[p_idx][a_idx],
             )
-
-            # store values in array.
-            out_dict['auc'][p_idx, a_idx] = auc_obs
-            out_dict['zscore'][p_idx, a_idx] = auc_zscore
-            out_dict['pval_raw'][p_idx, a_idx] = auc_pvalue
-
-        print('')
+            enrichment_curves.append([aa, pos] + list(curve_))
 
     # compute the FDR correction.
     out_dict['pval_fdr'] = enrichment.fdr_correction(
@@ -27,14 +27,16 @@ def main():
     # arrays for AUC scores.
     array_auc = np.zeros((len(positions), len(acids)))
 
-    for a_idx, aa in enumerate(acids):
-        for p_idx, pos in enumerate(positions):
+    for p_idx, pos in enumerate(positions):
+        codes, _ = enrichment.precompute_column(data_df[pos], acids)
+
+        for a_idx, aa in enumerate(acids):
 
             print(f'at AA={aa}, pos={pos}\r', end='')
 
-            df = data_df[pos]
-            curve_ = enrichment.enrichment_curves(df, aa)
-            array_auc[p_idx, a_idx] = enrichment.enrichment_auc(curve_)
+            array_auc[p_idx, a_idx] = enrichment.enrichment_auc_fast(
+                codes == a_idx
+            )
 
     # store data in dataframe.
     df = pd.DataFrame(
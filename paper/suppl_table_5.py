@@ -2,10 +2,10 @@
 # Author: Bastian Rieck
 # Modifications: Anja Gumpinger
 
-import collections
 import os
 import sys
 
+import numpy as np
 import pandas as pd
 
 # Import local modules.
@@ -14,35 +14,46 @@ import data
 import enrichment
 
 
-def get_all_scores(df, mode='max'):
+def get_all_scores(codes, n_acids, mode='max'):
     """Computes all scores for a data set.
 
     Args:
-        df (pd.DataFrame): columns correspond to positions, values to amino
-            acids at that position.
+        codes (np.array): amino acid codes (see
+            enrichment.precompute_column), rows correspond to positions,
+            columns to peptides.
+        n_acids (int): number of amino acids.
         mode: whether to report the AUC, or the MAX of the enrichment curve.
 
     Returns:
-        dict: enrichment scores for position, amino acid combinations.
+        np.array: enrichment scores, rows correspond to positions, columns to
+            amino acids. Scores of amino acids that do not occur at a
+            position are NaN.
+        np.array: number of occurrences, same shape as the scores.
     """
-    scores = collections.defaultdict(dict)
-    aa = data.aa_from_df(df)
-
-    for position in df.columns:
-        scores[position] = {}
-        for a in aa:
-            scores_ = enrichment.enrichment_curves(df[position], a)
-
+    scores = np.full((codes.shape[0], n_acids), np.nan)
+    counts = np.zeros((codes.shape[0], n_acids), dtype=np.int64)
+
+    for p_idx, column in enumerate(codes):
+        counts[p_idx] = np.bincount(column, minlength=n_acids)
+        buffer = np.empty(column.size)
+        for a_idx in np.flatnonzero(counts[p_idx]):
+
+            # Using the AUC of the enrichment profile, computed without
+            # constructing the curve.
+            if mode == 'auc':
+                scores[p_idx, a_idx] = enrichment.enrichment_auc_fast(
+                    column == a_idx
+                )
             # Compute enrichment scores.
-            if mode == 'max':
-                scores[position][a] = enrichment.enrichment_score(scores_)
-            # Using the AUC of the enrichment profile.
-            elif mode == 'auc':
-                scores[position][a] = enrichment.enrichment_auc(scores_)
+            elif mode == 'max':
+                scores_ = enrichment.enrichment_curves(
+                    column, a_idx, counts[p_idx, a_idx], out=buffer
+                )
+                scores[p_idx, a_idx] = enrichment.enrichment_score(scores_)
             else:
                 raise NotImplementedError
 
-    return scores
+    return scores, counts
 
 
 def main():
@@ -57,55 +68,83 @@ def main():
 
     # load data.
     df = data.load(f'{inpath}/{filename}', positions=[4, 17, 18, 19])
+    positions = sorted(df.columns)
+    acids = data.aa_from_df(df)
+
+    # encode all positions once. Subsets of the data are scored by indexing
+    # into these codes, which keeps the ranking of the peptides.
+    codes = np.stack([
+        enrichment.precompute_column(df[position], acids)[0]
+        for position in positions
+    ])
 
     # Get original scores for all position/amino acid combinations.
-    original_scores = get_all_scores(df, mode=mode)
+    original_scores, _ = get_all_scores(codes, len(acids), mode=mode)
 
     # Prepare all rows for the data frame of the interactions. Each
-    # entry of this list will contain tuples of the following form:
+    # block of this list will contain rows of the following form:
     #
-    #   Amino Acid, Position, Score
+    #   Position, Amino Acid (fixed), Position, Amino Acid
     #
-    # This is *repeated* to indicate that one acid has been fixed, and
-    # followed by a delta value, indicating the increase or decrease.
-    # Said delta is calculated based on the original scores of the
-    # second acid.
+    # given as indices into positions and acids. Together with the
+    # filtered scores, these determine the scores of both acids and
+    # the delta, indicating the increase or decrease. Said delta is
+    # calculated based on the original scores of the second acid.
     interactions = []
+    interaction_scores = []
+
+    for p1_idx, position1 in enumerate(positions):
+
+        # The position that is fixed is also dropped from the
+        # data because we must not use it any more here
+        # for further comparisons.
+        others = np.array([x for x in range(len(positions)) if x != p1_idx])
+        codes_others = codes[others]
+
+        # Partition the peptides by the acid in the fixed position once.
+        groups = df.groupby(position1, observed=True).indices
 
-    for position1 in sorted(original_scores):
-        for acid1 in sorted(original_scores[position1]):
+        for acid1, rows in groups.items():
 
             print(f'at {acid1}, Position {position1}', end='\r')
 
             # Fix the specified acid in the specified position and
             # re-calculate all the scores of the filtered data set
             # to learn about correlation effects.
-            #
-            # The position that is fixed is also dropped from the
-            # data frame because we must not use it any more here
-            # for further comparisons.
-            df_filtered = df.loc[df[position1] == acid1]
-            df_filtered = df_filtered.drop(position1, axis=1)
-
-            filtered_scores = get_all_scores(df_filtered, mode=mode)
-
-            for position2 in sorted(filtered_scores):
-                for acid2 in sorted(filtered_scores[position2]):
-
-                    score2 = filtered_scores[position2][acid2]
-                    delta = score2 - original_scores[position2][acid2]
-
-                    interactions.append({
-                        'AA1': acid2,
-                        'Position 1': position2,
-                        'AUC_AA1': original_scores[position2][acid2],
-                        'AA2': acid1,
-                        'Position 2': position1,
-                        'AUC_AA1 | AA2': score2,
-                        'Delta AUC': delta,
-                    })
-
-    df_out = pd.DataFrame(interactions)
+            codes_filtered = codes_others[:, rows]
+            filtered_scores, filtered_counts = get_all_scores(
+                codes_filtered, len(acids), mode=mode
+            )
+
+            # only report acids that occur in the filtered data set.
+            present = filtered_counts.any(axis=0)
+            o_idx, a2_idx = np.nonzero(
+                np.broadcast_to(present, filtered_scores.shape)
+            )
+
+            interactions.append(np.column_stack([
+                np.full(a2_idx.size, p1_idx),
+                np.full(a2_idx.size, acids.index(acid1)),
+                others[o_idx],
+                a2_idx,
+            ]))
+            interaction_scores.append(filtered_scores[o_idx, a2_idx])
+
+    p1_idx, a1_idx, p2_idx, a2_idx = np.concatenate(interactions).T
+    score2 = np.concatenate(interaction_scores)
+    score1 = original_scores[p2_idx, a2_idx]
+    acids_arr = np.asarray(acids)
+    positions_arr = np.asarray(positions)
+
+    df_out = pd.DataFrame({
+        'AA1': acids_arr[a2_idx],
+        'Position 1': positions_arr[p2_idx],
+        'AUC_AA1': score1,
+        'AA2': acids_arr[a1_idx],
+        'Position 2': positions_arr[p1_idx],
+        'AUC_AA1 | AA2': score2,
+        'Delta AUC': score2 - score1,
+    })
     df_out = df_out.sort_values('Delta AUC', ascending=False)
     df_out = df_out.set_index('AA1')
 
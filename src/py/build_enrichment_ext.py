@@ -0,0 +1,33 @@
+#!/usr/bin/python3
+# Compiles the numba kernels of the enrichment module ahead of time into the
+# extension module _enrichment_ext, which is used by enrichment if present.
+# This avoids the JIT compilation on startup of short scripts. Requires numba,
+# run with:
+#
+#   python build_enrichment_ext.py
+#
+# Note that numba.pycc is deprecated by numba. enrichment falls back to the
+# JIT/NumPy implementations if the extension module cannot be imported.
+
+import os
+
+from numba.pycc import CC
+
+import enrichment
+
+
+def main():
+
+    cc = CC('_enrichment_ext')
+    cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+    cc.export('hit_weights', 'i8(b1[:])')(enrichment._hit_weights)
+    cc.export('null_sums', 'i8[:](i1[:], i8[:])')(
+        enrichment._null_sums_numba.py_func
+    )
+
+    cc.compile()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,24 @@
 #!/usr/bin/python3
 # Author: Anja Gumpinger
 
+import functools
+import hashlib
+import os
+
+import numpy as np
 import pandas as pd
 
 
 def load(file, positions=range(23)):
     """Loads the data file into a pandas DataFrame object. The dataframe will
     contain one column per requested position, with name Pos{xx}. Rows are
-    ordered by strength, with strongest peptides at top of data frame.
+    ordered by strength, with strongest peptides at top of data frame. All
+    columns are categorical and share the same (sorted) amino acids as
+    categories, i.e. each cell is stored as an int8 code.
+
+    Parsed data is cached in memory, and on disk in a parquet file next to
+    the data file (if a parquet engine is installed). The parquet file is
+    only used while it is newer than the data file.
 
     Args:
         file (string): filename containing data.
@@ -18,15 +29,66 @@ def load(file, positions=range(23)):
         pd.DataFrame: data with one column per position.
     """
 
+    path = os.path.expanduser(file)
+
+    # the modification time is part of the key, such that changes of the
+    # data file invalidate the in-memory cache.
+    df = _load_cached(path, tuple(positions), os.path.getmtime(path))
+
+    return df.copy()
+
+
+@functools.lru_cache(maxsize=8)
+def _load_cached(path, positions, mtime):
+    """Loads the data file from its parquet cache if up to date, otherwise
+    parses it and updates the cache. See load for details.
+    """
+
+    key = hashlib.md5(str(positions).encode()).hexdigest()[:8]
+    cache = f'{path}.{key}.parquet'
+
+    if os.path.exists(cache) and os.path.getmtime(cache) >= mtime:
+        try:
+            return pd.read_parquet(cache)
+        except (ImportError, OSError, ValueError):
+
+            # no parquet engine installed, or unreadable cache file.
+            pass
+
+    df = _parse(path, positions)
+
+    try:
+        df.to_parquet(cache)
+    except (ImportError, OSError, ValueError):
+
+        # no parquet engine installed, or data directory not writable. Data
+        # is only cached in memory.
+        pass
+
+    return df
+
+
+def _parse(file, positions):
+    """Parses the data file, see load for details."""
+
     df = pd.read_csv(file, index_col=1)
 
+    # split all sequences into single characters at once, one row per
+    # peptide and one column per position.
+    seq = df['Sequence'].to_numpy(dtype=str)
+    chars = seq.view('U1').reshape(len(seq), -1)[:, list(positions)]
+
+    # encode the amino acids by their (integer) code points, shared by all
+    # positions.
+    codes, uniques = pd.factorize(chars.view(np.uint32).reshape(-1), sort=True)
+    codes = codes.astype(np.int8).reshape(chars.shape)
+    acids = [chr(x) for x in uniques]
+
     # create one column per position.
-    for p in positions:
-        if p < 10:
-            pos = f'Pos0{p+1}'
-        else:
-            pos = f'Pos{p+1}'
-        df[pos] = df['Sequence'].apply(lambda x: x[p])
+    for idx, p in enumerate(positions):
+        df[f'Pos{p+1:02d}'] = pd.Categorical.from_codes(
+            codes[:, idx], categories=acids
+        )
 
     df = df.drop('Sequence', axis=1)
     if 'lfcShrink4' in df.columns:
@@ -48,4 +110,13 @@ def aa_from_df(df):
         list: list of amino acids.
     """
 
-    return sorted(list(set(df.values.flatten())))
+    if df.shape[1] == 0:
+        return []
+
+    # all columns share the categories from data.load, only report the ones
+    # that occur in df.
+    categories = df.iloc[:, 0].cat.categories
+    codes = np.concatenate([df[col].cat.codes.to_numpy() for col in df])
+    present = np.bincount(codes, minlength=len(categories)) > 0
+
+    return list(categories[present])
@@ -3,51 +3,114 @@
 
 import numpy as np
 
+try:
+    import numba
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+# kernels compiled ahead of time with build_enrichment_ext.py.
+try:
+    from _enrichment_ext import hit_weights as _hit_weights_aot
+    from _enrichment_ext import null_sums as _null_sums_aot
+    _AOT_AVAILABLE = True
+except ImportError:
+    _AOT_AVAILABLE = False
+
 
 def remove_peptides_with_stopcodon(df, column, sc_index, sc_col):
     """Removes all rows (peptides) from data frame that have stop codon at
     any position preceding 'column'.
 
     Args:
-         df (pandas.DataFrame): data. Indices correspond to ranked peptides,
-            columns correspond to positions. The column names are supposed to
-            be of the following format: ['Pos1', 'Pos2', ...].
+         df (pandas.DataFrame): data. Indices correspond to ranked peptides
+            (sorted in ascending order), columns correspond to positions.
+            The column names are supposed to be of the following format:
+            ['Pos1', 'Pos2', ...].
          column (integer): current position.
-         sc_index (list): contains all indices (int) of peptides with stop
+         sc_index (np.array): contains all indices (int) of peptides with stop
             codon.
-         sc_col (list): contains all columns (int, 1-based) of peptides with
-            stop codon.
+         sc_col (np.array): contains all columns (int, 1-based) of peptides
+            with stop codon.
 
     Returns:
-        pandas.Series: data Series containing amino acids at current position
-            (column). Rows (peptides) with stop codons have been removed.
+        np.array or pandas.Categorical: amino acids at current position
+            (column), i.e. the values of the column. Rows (peptides) with
+            stop codons have been removed.
     """
     data = df[column]
 
     # find rows (peptides) that previously had a stop codon and should be
     # excluded from analyses.
     col_value = int(column.strip('Pos'))
-    row_remove = [x for x, y in zip(sc_index, sc_col) if col_value > y]
+    row_remove = np.asarray(sc_index)[np.asarray(sc_col) < col_value]
 
     # remove the rows from data, if start codon detected before the current
-    # position.
-    if len(row_remove) > 0:
-        data.drop(axis=0, index=row_remove, inplace=True)
-        return data
+    # position. The index is sorted, such that the rows can be located by
+    # binary search.
+    row_idx = np.searchsorted(data.index.values, row_remove)
+
+    # binary search returns insertion points, make sure all rows exist.
+    found = row_idx < len(data)
+    found[found] = data.index.values[row_idx[found]] == row_remove[found]
+    assert found.all(), 'peptides with stop codon not found in data'
+
+    keep_mask = np.ones(len(data), dtype=bool)
+    keep_mask[row_idx] = False
+
+    return data.values[keep_mask]
+
+
+def precompute_column(column, acids):
+    """Encodes the amino acids at the current position as integer codes,
+    such that all amino acids can be scored from a single pass over the
+    column.
+
+    Args:
+        column (pandas.Series, pandas.Categorical or np.array): amino acids
+            for all peptides (indices) at current position. Rows are assumed
+            to be ranked by activity. Categorical data (see data.load) is
+            encoded from its codes without comparing strings.
+        acids (list): amino acids of interest.
+
+    Returns:
+        np.array: int8 code of every peptide, i.e. the index of its amino
+            acid in acids (-1 if not contained in acids).
+        np.array: number of occurrences of every amino acid in acids.
+    """
+
+    if hasattr(column, 'cat'):
+        column = column.values
+
+    if hasattr(column, 'categories'):
+        uniques = column.categories
+        inverse = np.asarray(column.codes)
     else:
-        return data
+        uniques, inverse = np.unique(np.asarray(column), return_inverse=True)
+
+    # map the (few) unique values to their index in acids.
+    lookup = {acid: idx for idx, acid in enumerate(acids)}
+    mapping = np.array([lookup.get(x, -1) for x in uniques], dtype=np.int8)
+    codes = mapping[inverse.reshape(-1)]
 
+    counts = np.bincount(codes + 1, minlength=len(acids) + 1)[1:]
 
-def enrichment_curves(df, acid):
+    return codes, counts
+
+
+def enrichment_curves(codes, code, m, out=None):
     """Creates the GSE representation as proposed in Subramanian et al. (
     2005) for the current position (implicitly encoded in data).
 
     Args:
-        df (pandas.Series): amino acids for all peptides (indices) at current
-            position (the Series is extracted from a data frame where each
-            column corresponds to one position, and df is a column of this
-            data frame). Rows are assumed to be ranked by activity.
-        acid (string): amino acid of interest.
+        codes (np.array): amino acid codes for all peptides (indices) at
+            current position, as returned by precompute_column. Rows are
+            assumed to be ranked by activity.
+        code (int): code of the amino acid of interest.
+        m (int): number of occurrences of the amino acid of interest.
+        out (np.array): buffer of n floats the curve is written to, allows
+            to reuse one buffer across calls. Defaults to None, i.e. a new
+            array is allocated.
 
     Returns:
          np.array: 1 dimensional array with random walk representing ranking.
@@ -59,92 +122,229 @@ def enrichment_curves(df, acid):
     """
 
     # number of all recorded values (required for normalisation below)
-    n = len(df)
+    n = codes.size
 
-    counts = df.value_counts()
-
-    # get number of hits for the specified acid if it exists
-    if acid in counts:
-        m = counts[acid]
-    else:
+    if m == 0:
 
         # Not sure whether this is the best score to report, but if the
         # acid does not exist, there's no way around it.
-        return []
+        return np.empty(0)
 
-    curve = df.copy()
-
-    mask = curve == acid
+    # if all peptides carry the acid, the curve does not depend on the
+    # ranking.
+    if m == n:
+        return np.divide(np.arange(1, n + 1), m, out=out)
 
     # Normalisation. Required to make resulting curves comparable when the
     # number of sequences varies.
-    curve.loc[~mask] = -1 / (n - m)
-    curve.loc[mask] = 1 / m
+    if out is None:
+        out = np.empty(n, dtype=np.float64)
+
+    # the kernel compares, normalises and sums in a single pass.
+    if _NUMBA_AVAILABLE:
+        return _curve_numba(codes, code, m, out)
+
+    np.copyto(out, -1.0 / (n - m))
+    out[codes == code] = 1.0 / m
 
-    return curve.cumsum().values
+    return np.cumsum(out, out=out)
 
 
-def enrichment_scores_null(df, acid, n_perm=100, mode='auc'):
+def enrichment_scores_null(codes, code, m, n_perm=100, mode='auc',
+                           rng=None):
     """Computes the null distribution of enrichment scores or AUC using the GSE
     representation as proposed in Subramanian et al. (2005) by using
     permutations.
 
     Args:
-        df (pandas.Series): amino acids for all peptides (indices) at current
-            position (the Series is extracted from a data frame where each
-            column corresponds to one position, and df is a column of this
-            data frame). Rows are assumed to be ranked by activity.
-        acid (string): amino acid of interest.
+        codes (np.array): amino acid codes for all peptides (indices) at
+            current position, as returned by precompute_column. Rows are
+            assumed to be ranked by activity.
+        code (int): code of the amino acid of interest.
+        m (int): number of occurrences of the amino acid of interest.
         n_perm (int): number of permutations. Note that the choice of this
             parameter significantly impacts runtime.
         mode (string): whether to compute enrichment scores or AUC.
             (options: 'auc' or 'max')
+        rng (np.random.Generator): random number generator used for the
+            permutations. Pass independent generators (e.g. spawned from one
+            np.random.SeedSequence) when running in parallel. Defaults to
+            None, i.e. a new generator seeded with fresh entropy.
 
     Returns:
-        list: null distribution of enrichment scores/AUCs.
+        np.array: null distribution of enrichment scores/AUCs.
     """
 
     # number of all recorded values (required for the normalisation
     # below)
-    n = len(df)
+    n = codes.size
 
-    counts = df.value_counts()
-
-    # get number of hits for the specified acid if it exists
-    if acid in counts:
-        m = counts[acid]
-    else:
+    if m == 0:
 
         # Not sure whether this is the best score to report, but if the
         # acid does not exist, there's no way around it.
-        return []
+        return np.empty(0)
 
-    curve = df.copy()
-
-    mask = curve == acid
-
-    # Normalisation. Required to make resulting curves comparable when the
-    # number of sequences varies.
-    curve.loc[~mask] = -1 / (n - m)
-    curve.loc[mask] = 1 / m
+    if mode not in ('auc', 'max'):
+        print('Invalid mode')
+        return None
 
-    curve = curve.values
-    null_values = []
-    for x in range(n_perm):
-        curve = np.random.permutation(curve)
-        tmp_ = np.cumsum(curve)
+    # if all peptides carry the acid, every permutation yields the same
+    # curve.
+    if m == n:
+        if mode == 'auc':
+            return np.full(n_perm, enrichment_auc_fast(codes == code))
+        curve = enrichment_curves(codes, code, m)
+        return np.full(n_perm, enrichment_score(curve))
+
+    # The permutations only shuffle the signs of the steps (+1 for hits, -1
+    # otherwise), which are stored as int8. Normalisation is applied after
+    # summation: with k_i hits among the first i + 1 peptides, the summed
+    # signs are s_i = 2 * k_i - (i + 1), and the curve is
+    # k_i / m - (i + 1 - k_i) / (n - m).
+    signs = np.where(codes == code, np.int8(1), np.int8(-1))
+    pos_val = 1.0 / m
+    neg_val = 1.0 / (n - m)
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # the AUC kernels shuffle and sum each permutation in a single pass,
+    # without materialising the matrix of permutations. The precompiled
+    # kernel is preferred, as it does not need to be compiled at runtime.
+    # Both kernels yield the same null values for the same seeds. Every
+    # permutation gets its own seed drawn from rng, which keeps the streams
+    # of different generators (e.g. spawned per job) independent.
+    if mode == 'auc' and (_AOT_AVAILABLE or _NUMBA_AVAILABLE):
+        seeds = rng.integers(2**32, size=n_perm)
+        if _AOT_AVAILABLE:
+            sums = _null_sums_aot(signs, seeds)
+        else:
+            sums = _null_sums_numba(signs, seeds)
+        return _auc_from_sums(sums, n, pos_val, neg_val)
+
+    # permutations are shuffled and summed row-wise in one batch. Batches are
+    # limited to roughly 10^7 entries to bound the size of the temporary
+    # matrices.
+    batch_size = max(1, 10**7 // n)
+    steps = np.arange(1, n + 1)
+    null_values = np.empty(n_perm)
+
+    for start in range(0, n_perm, batch_size):
+        stop = min(start + batch_size, n_perm)
+        perms = np.broadcast_to(signs, (stop - start, n)).copy()
+        rng.permuted(perms, axis=1, out=perms)
+        csum = perms.cumsum(axis=1, dtype=np.int32)
 
         if mode == 'auc':
-            null_values.append(np.mean(tmp_))
-        elif mode == 'max':
-            null_values.append(enrichment_score(tmp_))
+            sums = csum.sum(axis=1, dtype=np.int64)
+            null_values[start:stop] = _auc_from_sums(
+                sums, n, pos_val, neg_val
+            )
         else:
-            print('Invalid mode')
-            null_values = None
+            hits = (csum + steps) // 2
+            curves = hits * (pos_val + neg_val) - steps * neg_val
+            # same rule as in enrichment_score, applied row-wise.
+            max_idx = curves.argmax(axis=1)
+            min_idx = curves.argmin(axis=1)
+            rows = np.arange(stop - start)
+            max_vals = curves[rows, max_idx]
+            min_vals = curves[rows, min_idx]
+            use_max = (max_vals > -min_vals) | (
+                (max_vals == -min_vals) & (max_idx < min_idx)
+            )
+            null_values[start:stop] = np.where(use_max, max_vals, min_vals)
 
     return null_values
 
 
+def _auc_from_sums(sums, n, pos_val, neg_val):
+    """Computes the AUC of enrichment curves from their summed signs.
+
+    Args:
+        sums (np.array): sum over the cumulative sum of the signs (+1 for
+            hits, -1 otherwise) of each curve.
+        n (int): number of peptides.
+        pos_val (float): step of the curve for hits.
+        neg_val (float): step of the curve (absolute) for all other peptides.
+
+    Returns:
+        np.array: AUC of each curve.
+    """
+
+    # sum of k_i over the curve, see enrichment_scores_null.
+    all_steps = n * (n + 1) // 2
+    hits = (sums + all_steps) / 2
+
+    return ((pos_val + neg_val) * hits - neg_val * all_steps) / n
+
+
+if _NUMBA_AVAILABLE:
+
+    @numba.njit(cache=True, parallel=True)
+    def _null_sums_numba(signs, seeds):
+        """Shuffles the signs of the steps of an enrichment curve once per
+        seed and sums their cumulative sum, see _auc_from_sums.
+
+        Args:
+            signs (np.array): int8 signs of the steps of the curve.
+            seeds (np.array): one seed (< 2**32) per permutation. Numba keeps
+                one generator per thread, which is re-seeded with seeds[p]
+                for permutation p, such that the null values do not depend
+                on the number of threads.
+
+        Returns:
+            np.array: sum over the cumulative sum of each permutation.
+        """
+        n = signs.size
+        n_perm = seeds.size
+        sums = np.empty(n_perm, dtype=np.int64)
+
+        for p in numba.prange(n_perm):
+            np.random.seed(seeds[p])
+            buf = signs.copy()
+
+            # Fisher-Yates shuffle.
+            for i in range(n - 1, 0, -1):
+                j = np.random.randint(0, i + 1)
+                buf[i], buf[j] = buf[j], buf[i]
+
+            # running sum of the signs and of their cumulative sum.
+            s = 0
+            total = 0
+            for k in range(n):
+                s += buf[k]
+                total += s
+            sums[p] = total
+
+        return sums
+
+    @numba.njit(cache=True, fastmath=True, boundscheck=False)
+    def _curve_numba(codes, code, m, out):
+        """Writes the enrichment curve of an amino acid to out, see
+        enrichment_curves.
+
+        Args:
+            codes (np.array): amino acid codes for all peptides.
+            code (int): code of the amino acid of interest.
+            m (int): number of occurrences of the amino acid (0 < m < n).
+            out (np.array): buffer of n floats.
+
+        Returns:
+            np.array: out.
+        """
+        n = codes.size
+        pos_val = 1.0 / m
+        neg_val = -1.0 / (n - m)
+
+        acc = 0.0
+        for i in range(n):
+            acc += pos_val if codes[i] == code else neg_val
+            out[i] = acc
+
+        return out
+
+
 def enrichment_score(curve):
     """Computes the enrichment score as the most extreme value of
     the enrichment curve, as described in Subramanian et al. (2005).
@@ -155,7 +355,17 @@ def enrichment_score(curve):
     Returns:
         float: enrichment score.
     """
-    return curve[np.abs(curve).argmax()]
+    # the most extreme value is either the maximum or the minimum, which
+    # avoids allocating the absolute values of the curve. On ties, the value
+    # occurring first is reported.
+    max_idx = curve.argmax()
+    min_idx = curve.argmin()
+    max_val = curve[max_idx]
+    min_val = curve[min_idx]
+
+    if max_val > -min_val or (max_val == -min_val and max_idx < min_idx):
+        return max_val
+    return min_val
 
 
 def enrichment_auc(curve):
@@ -170,6 +380,57 @@ def enrichment_auc(curve):
     return np.mean(curve)
 
 
+def enrichment_auc_fast(mask):
+    """Computes the AUC under the enrichment curve directly from the hits,
+    without constructing the curve.
+
+    Args:
+        mask (np.array): boolean array, indicates for all peptides whether
+            they carry the amino acid of interest. Rows are assumed to be
+            ranked by activity.
+
+    Returns:
+        float: AUC, NaN if the amino acid does not occur.
+
+    Note:
+        * Step k (0-based) of the curve contributes to the last n - k values
+          of its cumulative sum, i.e. the AUC is a weighted sum over the
+          positions of the hits.
+    """
+    n = mask.size
+    m = np.count_nonzero(mask)
+
+    if m == 0:
+        return np.nan
+
+    if m == n:
+        return (n + 1) / (2 * n)
+
+    if _AOT_AVAILABLE:
+        hit_weights = _hit_weights_aot(mask)
+    else:
+        hit_weights = _hit_weights(mask)
+
+    # the AUC is computed from the summed signs of the steps, exactly as for
+    # the permutations (see enrichment_scores_null). Hence identical
+    # arrangements yield identical AUCs, which is required to count ties in
+    # twosided_pvalue.
+    sums = 2 * hit_weights - n * (n + 1) // 2
+
+    return _auc_from_sums(sums, n, 1.0 / m, 1.0 / (n - m))
+
+
+def _hit_weights(mask):
+    """Computes the sum of the weights (n - k) of all hits, see
+    enrichment_auc_fast. Only uses numba-compatible operations, such that it
+    can be compiled ahead of time.
+    """
+    n = mask.size
+    positives = np.flatnonzero(mask)
+
+    return positives.size * n - positives.sum()
+
+
 def zscore(x, mu, std):
     """Computes z-score of x.
 
@@ -191,18 +452,17 @@ def twosided_pvalue(obs, null):
 
     Args:
         obs (float): observed value.
-        null (list): list of floats, contains null values.
+        null (np.array): contains null values.
 
     Returns:
         float: two-sided permutation p-value.
     """
 
-    if len(null) == 0:
+    null = np.asarray(null)
+    if null.size == 0:
         return 1.0
 
-    n_perm = len(null)
-    numerator = len([1 for x in null if np.abs(x) >= np.abs(obs)])
-    return numerator/n_perm
+    return np.count_nonzero(np.abs(null) >= abs(obs)) / null.size
 
 
 def fdr_correction(pvalues, alpha=0.1):
@@ -243,17 +503,21 @@ def benjamini_hochberg(pvalues, alpha=0.05):
       np.array: corresponding q-values.
     """
 
-    pvals_arr = np.asarray(pvalues)
-
-    # get the sorting indices of the list.
-    sort_idx = sorted(range(pvals_arr.size), key=lambda x: pvals_arr[x])
+    pvals_arr = np.asarray(pvalues, dtype=np.float64)
+    n = pvals_arr.size
 
-    qvals_arr = np.ones(pvals_arr.size)
+    # get the rank of every p-value.
+    sort_idx = np.argsort(pvals_arr, kind='stable')
+    ranks = np.empty_like(sort_idx)
+    ranks[sort_idx] = np.arange(1, n + 1)
 
-    qvals_arr[sort_idx] = np.arange(1, pvals_arr.size+1) / pvals_arr.size
-    qvals_arr *= alpha
+    # BH-adjusted p-values, made monotone by the step-up procedure, i.e. the
+    # q-value of a p-value is the minimum over all larger p-values.
+    qvals_arr = pvals_arr * n / ranks
+    qvals_sorted = np.minimum.accumulate(qvals_arr[sort_idx][::-1])[::-1]
+    qvals_arr[sort_idx] = np.minimum(qvals_sorted, 1.0)
 
-    is_sig = pvals_arr <= qvals_arr
+    is_sig = qvals_arr <= alpha
 
     return is_sig, qvals_arr
 